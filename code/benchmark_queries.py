@@ -0,0 +1,59 @@
+from datetime import datetime
+import csv
+import json
+from sys import argv
+import os
+from db import connect
+
+# The canonical lookups made by build_model.py and chart_play.py, keyed by name
+QUERIES = {
+    "ball_carrier_at_catch": ("SELECT x, y, lr, team FROM tracking WHERE game_id=%(game_id)s AND play_id=%(play_id)s "
+                              "AND player_id=%(player_id)s AND event='pass_arrived'"),
+    "defenders_at_catch": ("SELECT player_id, x, y, speed, acceleration FROM tracking "
+                           "WHERE game_id=%(game_id)s AND play_id=%(play_id)s AND team!='FB' AND event='pass_arrived'"),
+    "play_frame": ("SELECT player_id, team, orientation, x, y, speed_x, speed_y, acc_x, acc_y, jerseynumber "
+                   "FROM tracking WHERE game_id=%(game_id)s AND play_id=%(play_id)s AND frame_id=%(frame_id)s"),
+    "play_max_frame": "SELECT MAX(frame_id) FROM tracking WHERE game_id=%(game_id)s AND play_id=%(play_id)s",
+    "play_tacklers": ("SELECT player_id FROM tackles WHERE game_id=%(game_id)s AND play_id=%(play_id)s "
+                      "AND (tackle='t' OR assist='t')"),
+}
+
+
+def sample_play(cur):
+    """Pick a passing play to run the canonical queries against"""
+    cur.execute("SELECT t.game_id, t.play_id, t.player_id, t.frame_id FROM plays p JOIN tracking t "
+                "ON t.game_id=p.game_id AND t.play_id=p.play_id AND t.player_id=p.ball_carrier "
+                "WHERE t.event='pass_arrived' ORDER BY t.game_id, t.play_id LIMIT 1")
+    return dict(zip(["game_id", "play_id", "player_id", "frame_id"], cur.fetchone()))
+
+
+def benchmark_queries(output: str = "query_benchmark.csv", repeats: int = 5):
+    """Record EXPLAIN ANALYZE timings for the canonical queries and append them to a CSV file"""
+    with connect() as conn:
+        cur = conn.cursor()
+        params = sample_play(cur)
+        run_at = datetime.now().isoformat(timespec="seconds")
+        results = []
+        for name, query in QUERIES.items():
+            timings = []
+            for _ in range(repeats):
+                cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params)
+                plan = cur.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                timings.append(plan[0]["Planning Time"] + plan[0]["Execution Time"])
+            # Use the median so a cold cache on the first run doesn't skew the result
+            timings.sort()
+            node = plan[0]["Plan"]
+            results.append([run_at, name, timings[len(timings) // 2], node["Node Type"], node.get("Index Name", "")])
+            print(f"{name}: {results[-1][2]:.3f} ms ({node['Node Type']})")
+    write_header = not os.path.exists(output)
+    with open(output, "a", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(["run_at", "query", "median_ms", "plan_node", "index"])
+        writer.writerows(results)
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_queries(*argv[1:2])
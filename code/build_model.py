@@ -1,102 +1,214 @@
-from joblib import dump, load
+from joblib import dump
 import math
 import numpy as np
+import pandas as pd
 from sklearn.linear_model import LogisticRegression
-import psycopg2
+from psycopg2.extras import execute_values
 import os
-from dotenv import load_dotenv
-load_dotenv()
-connection_string = os.environ["connection_string"]
-
-
-def star_tackles_missed():
-    """Calculate total tackles missed"""
-    model = load("model.joblib")
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    for i in range(1, 6):
-        cur.execute("UPDATE players SET star_{0}_missed=0".format(i))
-    cur.execute("SELECT game_id, play_id, ball_carrier FROM plays")
-    plays = cur.fetchall()
-    for play in plays:
-        cur.execute("SELECT x, y, lr, team FROM tracking WHERE game_id=%s AND play_id=%s AND player_id=%s "
-                    "AND event='pass_arrived'", play)
-        ball_carrier = cur.fetchone()
-        if ball_carrier is None:  # This means that the play was not a passing play
-            continue
-        # Get player data for the non-tacklers
-        cur.execute("SELECT player_id, x, y, speed, acceleration FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id "
-                    "NOT IN (SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s "
-                    "AND (tackle='t' OR assist='t')) AND event='pass_arrived'",
-                    list(play[:2]) + [ball_carrier[3]] + list(play[:2]))
-        non_tacklers = cur.fetchall()
-        non_tacklers_x = [[math.sqrt(abs(ball_carrier[1] - tackler[2])),  # Sqrt of lateral distance
-                           math.sqrt(math.sqrt((ball_carrier[0] - tackler[1]) ** 2
-                                               + (ball_carrier[1] - tackler[2]) ** 2)),  # Sqrt of Euclidean distance
-                           tackler[3], tackler[4]] for tackler in non_tacklers]  # Speed and acceleration
-        tackler_probability = model.predict_proba(non_tacklers_x) if non_tacklers_x else []  # Predict probabilities
-        for i, tackler in enumerate(tackler_probability):
-            # Assign a star value passed on the probability
-            if tackler[1] > 0.90:
-                stars = "1"
-            elif tackler[1] > 0.75:
-                stars = "2"
-            elif tackler[1] > 0.5:
-                stars = "3"
-            elif tackler[1] > 0.25:
-                stars = "4"
-            else:
-                stars = "5"
-            cur.execute("UPDATE players SET star_{0}_missed=star_{0}_missed+1 WHERE id=%s".format(stars),
-                        (non_tacklers[i][0],))
-    conn.commit()
-    conn.close()
-
-
-def star_tackles_made():
-    """Calculate total star tackles made by each player"""
-    model = load("model.joblib")
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    for i in range(1, 6):
-        cur.execute("UPDATE players SET star_{0}_made=0".format(i))
-    cur.execute("SELECT game_id, play_id, ball_carrier FROM plays")
-    plays = cur.fetchall()
-    for play in plays:
-        cur.execute("SELECT x, y, lr, team FROM tracking WHERE game_id=%s AND play_id=%s AND player_id=%s "
-                    "AND event='pass_arrived'", play)
-        ball_carrier = cur.fetchone()
-        if ball_carrier is None:  # This means the play was not a passing play
-            continue
-        # Get player data
-        cur.execute("SELECT player_id, x, y, speed, acceleration FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id "
-                    "IN (SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s AND (tackle='t' OR assist='t')) "
-                    "AND event='pass_arrived'", list(play[:2]) + [ball_carrier[3]] + list(play[:2]))
-        tacklers = cur.fetchall()
-        tacklers_x = [[math.sqrt(abs(ball_carrier[1] - tackler[2])),  # Sqrt of lateral distance
-                       math.sqrt(math.sqrt((ball_carrier[0] - tackler[1]) ** 2
-                                           + (ball_carrier[1] - tackler[2]) ** 2)),  # Sqrt of Euclidean distance
-                       tackler[3], tackler[4]]  # Speed and acceleration
-                      for tackler in tacklers]
-        tackler_probability = model.predict_proba(tacklers_x) if tacklers_x else []
-        for i, tackler in enumerate(tackler_probability):
-            # Assign a star value to the tackle
-            if tackler[1] > 0.90:
-                stars = "1"
-            elif tackler[1] > 0.75:
-                stars = "2"
-            elif tackler[1] > 0.5:
-                stars = "3"
-            elif tackler[1] > 0.25:
-                stars = "4"
-            else:
-                stars = "5"
-            cur.execute("UPDATE players SET star_{0}_made=star_{0}_made+1 WHERE id=%s".format(stars),
-                        (tacklers[i][0], ))
-    conn.commit()
-    conn.close()
+from create_db import build_catch_snapshots
+from db import connect, stream_chunks
+from models import load_model
+import storage
+from storage import CATCH_DEFENDERS_COLUMNS, CATCH_DEFENDERS_QUERY, catch_defender_chunks, read_table
+
+
+def score_tackle_probabilities(game_ids: list = None, new_only: bool = False):
+    """Score defenders at the moment of the catch in one model pass and store them in tackle_probabilities
+
+    By default the whole season is rescored. game_ids rescores only those games and new_only scores only the
+    plays that have not been scored yet.
+    """
+    model, version = load_model("model.joblib")
+    if storage.backend == "parquet":
+        return score_tackle_probabilities_parquet(model, version, game_ids, new_only)
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS tackle_probabilities (game_id INT, play_id INT, player_id INT, "
+                    "prob FLOAT, model_version TEXT, PRIMARY KEY (game_id, play_id, player_id))")
+        # Tables scored before probabilities were versioned lack the column
+        cur.execute("ALTER TABLE tackle_probabilities ADD COLUMN IF NOT EXISTS model_version TEXT")
+        query, params = CATCH_DEFENDERS_QUERY, []
+        if game_ids is not None:
+            query += " AND game_id = ANY(%s)"
+            params.append(list(game_ids))
+            cur.execute("DELETE FROM tackle_probabilities WHERE game_id = ANY(%s)", (list(game_ids),))
+        elif new_only:
+            query += (" AND NOT EXISTS (SELECT 1 FROM tackle_probabilities tp "
+                      "WHERE tp.game_id=catch_snapshots.game_id AND tp.play_id=catch_snapshots.play_id)")
+        else:
+            cur.execute("TRUNCATE tackle_probabilities")
+        # Score in fixed-size chunks so memory stays bounded however many plays are scored
+        for defenders in stream_chunks(conn, query, params):
+            x = np.array([defender[4:8] for defender in defenders], dtype=np.float64)
+            probabilities = model.predict_proba(x)[:, 1]
+            execute_values(cur, "INSERT INTO tackle_probabilities (game_id, play_id, player_id, prob, model_version) "
+                           "VALUES %s", [defender[:3] + (float(prob), version)
+                                         for defender, prob in zip(defenders, probabilities)], page_size=10000)
+
+
+def score_tackle_probabilities_parquet(model, version: str, game_ids: list = None, new_only: bool = False):
+    """Score defenders at the moment of the catch into tackle_probabilities.parquet with one in-process scan"""
+    path = os.path.join(storage.parquet_dir, "tackle_probabilities.parquet")
+    keep = os.path.exists(path) and (game_ids is not None or new_only)
+    scored = pd.read_parquet(path) if keep else pd.DataFrame(columns=["game_id", "play_id", "player_id", "prob",
+                                                                      "model_version"])
+    filters = [("defender", "==", True)]
+    if game_ids is not None:
+        filters.append(("game_id", "in", list(game_ids)))
+        scored = scored[~scored["game_id"].isin(list(game_ids))]
+    defenders = read_table("catch_snapshots", CATCH_DEFENDERS_COLUMNS, filters)
+    if new_only:
+        plays = pd.MultiIndex.from_frame(scored[["game_id", "play_id"]])
+        defenders = defenders[~pd.MultiIndex.from_frame(defenders[["game_id", "play_id"]]).isin(plays)]
+    if len(defenders) == 0:
+        return 0
+    defenders["prob"] = model.predict_proba(defenders[CATCH_DEFENDERS_COLUMNS[4:8]].to_numpy(dtype=np.float64))[:, 1]
+    defenders["model_version"] = version
+    pd.concat([scored, defenders[["game_id", "play_id", "player_id", "prob", "model_version"]]],
+              ignore_index=True).to_parquet(path, index=False)
+    return len(defenders)
+
+
+def read_frame(cur, query: str, params, columns: list):
+    """Read a large query into a frame through stream_chunks on cur's connection, so it stays in cur's transaction"""
+    frames = [pd.DataFrame(chunk, columns=columns) for chunk in stream_chunks(cur.connection, query, params)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def load_tackle_probabilities(cur, game_ids: list = None, new_only: bool = False):
+    """Load the scored defenders with their team and whether they made the tackle
+
+    game_ids limits them to those games and new_only to the plays without stored contributions.
+    """
+    query, params = ("SELECT tp.game_id, tp.play_id, tp.player_id, tp.prob, cs.team, cs.tackler, tp.model_version "
+                     "FROM tackle_probabilities tp JOIN catch_snapshots cs "
+                     "ON cs.game_id=tp.game_id AND cs.play_id=tp.play_id AND cs.player_id=tp.player_id"), None
+    if game_ids is not None:
+        query, params = query + " WHERE tp.game_id = ANY(%s)", (list(game_ids),)
+    elif new_only:
+        # Also picks up plays left over from a failed run
+        query += (" WHERE NOT EXISTS (SELECT 1 FROM tackle_contributions c "
+                  "WHERE c.game_id=tp.game_id AND c.play_id=tp.play_id)")
+    return read_frame(cur, query, params, ["game_id", "play_id", "player_id", "prob", "team", "tackler",
+                                           "model_version"])
+
+
+def star_buckets(probabilities):
+    """Assign a star value to each tackle probability, from 1 star (> 90%) to 5 stars (<= 25%)"""
+    return 5 - np.digitize(probabilities, [0.25, 0.5, 0.75, 0.9], right=True)
+
+
+def increment_columns(cur, table: str, key: str, totals):
+    """Add per-key totals to the columns of a table in a single UPDATE ... FROM (VALUES ...)"""
+    columns = list(totals.columns)
+    execute_values(cur, "UPDATE {0} SET {1} FROM (VALUES %s) AS v({2}, {3}) WHERE {0}.{2}=v.{2}".format(
+                       table, ", ".join("{0}={0}+v.{0}".format(column) for column in columns), key, ", ".join(columns)),
+                   list(totals.reset_index().itertuples(index=False, name=None)), page_size=max(len(totals), 1))
+
+
+def star_totals(df, suffix: str):
+    """Count each player's tackles in every star bucket as star_N_<suffix> columns"""
+    totals = df.groupby(["player_id", "stars"]).size().unstack(fill_value=0)
+    totals = totals.reindex(columns=range(1, 6), fill_value=0).astype(int)
+    return totals.rename(columns=lambda stars: "star_{0}_{1}".format(stars, suffix))
+
+
+def taa_contributions(df):
+    """Calculate each defender's tackles above expected contribution on every play"""
+    play = ["game_id", "play_id"]
+    # An empty result has object columns, which pandas would read as a column selection rather than a mask
+    tackler = df["tackler"].astype(bool)
+    tacklers = df[tackler]
+    non_tacklers = df[~tackler].join(tacklers.groupby(play)["prob"].max().rename("max_tackler_prob"), on=play)
+    # If there was no tackle made on the play, assign the missed tackle to the player with the highest probability
+    no_tackle = non_tacklers[non_tacklers["max_tackler_prob"].isna()]
+    missed = no_tackle.loc[no_tackle.groupby(play)["prob"].idxmax()] if len(no_tackle) else no_tackle
+    # Decrement the TAA of each non-tackler with a tackle probability of at least 25% higher than the highest tackler
+    outperformed = non_tacklers[non_tacklers["prob"] >= non_tacklers["max_tackler_prob"] + 0.25]
+    # Increment the TAA of each tackler
+    return pd.concat([tacklers.assign(taa=1 - tacklers["prob"]),
+                      missed.assign(taa=-missed["prob"]),
+                      outperformed.assign(taa=-outperformed["prob"])])[play + ["player_id", "team", "taa"]]
+
+
+CONTRIBUTION_COLUMNS = ["game_id", "play_id", "player_id", "team", "tackler", "stars", "tackles_above_expected",
+                        "model_version"]
+
+
+def play_contributions(df):
+    """Calculate what every scored defender adds to the player and team aggregates on their play"""
+    key = ["game_id", "play_id", "player_id"]
+    taa = taa_contributions(df).groupby(key)["taa"].sum().rename("tackles_above_expected")
+    df = df.assign(stars=star_buckets(df["prob"])).join(taa, on=key)
+    df["tackles_above_expected"] = df["tackles_above_expected"].fillna(0.0)
+    return df[CONTRIBUTION_COLUMNS]
+
+
+def aggregate_contributions(df):
+    """Sum per-play contributions into the players and teams aggregate columns"""
+    tackler = df["tackler"].astype(bool)
+    stars = pd.concat([star_totals(df[tackler], "made"), star_totals(df[~tackler], "missed")], axis=1)
+    players = pd.concat([stars.fillna(0).astype(int), df.groupby("player_id")[["tackles_above_expected"]].sum()],
+                        axis=1).fillna(0)
+    teams = df.groupby("team")[["tackles_above_expected"]].sum()
+    return players, teams
+
+
+def refresh_contributions(cur, game_ids: list = None, new_only: bool = False):
+    """Recompute the stored contributions of every scored play and return the old and new ones
+
+    game_ids limits this to those games and new_only to the plays without stored contributions.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS tackle_contributions (game_id INT, play_id INT, player_id INT, "
+                "team TEXT, tackler BOOL, stars INT, tackles_above_expected FLOAT, model_version TEXT, "
+                "PRIMARY KEY (game_id, play_id, player_id))")
+    # Ledgers built before contributions were versioned lack the column
+    cur.execute("ALTER TABLE tackle_contributions ADD COLUMN IF NOT EXISTS model_version TEXT")
+    new = play_contributions(load_tackle_probabilities(cur, game_ids, new_only))
+    old = pd.DataFrame(columns=CONTRIBUTION_COLUMNS)
+    if not new_only:  # New plays have no stored contributions to replace
+        where, params = ("TRUE", None) if game_ids is None else ("game_id = ANY(%s)", (list(game_ids),))
+        old = read_frame(cur, "SELECT " + ", ".join(CONTRIBUTION_COLUMNS) + " FROM tackle_contributions WHERE " + where,
+                         params, CONTRIBUTION_COLUMNS)
+        cur.execute("DELETE FROM tackle_contributions WHERE " + where, params)
+    execute_values(cur, "INSERT INTO tackle_contributions (" + ", ".join(CONTRIBUTION_COLUMNS) + ") VALUES %s",
+                   list(new.itertuples(index=False, name=None)), page_size=10000)
+    return old, new
+
+
+def update_aggregates(game_ids: list = None):
+    """Score only the new plays, or replay the given games, and update the player and team aggregates by the change
+
+    Replay a game after loading its corrected tackles file with upload_tackles; its catch snapshots are rebuilt here.
+    """
+    if game_ids is not None:
+        build_catch_snapshots(game_ids=game_ids)  # The snapshots hold the tackler flags read from tackles
+    score_tackle_probabilities(game_ids, new_only=game_ids is None)
+    with connect() as conn:
+        cur = conn.cursor()
+        old, new = refresh_contributions(cur, game_ids, new_only=game_ids is None)
+        (new_players, new_teams), (old_players, old_teams) = aggregate_contributions(new), aggregate_contributions(old)
+        players = new_players.sub(old_players, fill_value=0).astype(float)
+        players = players.astype({column: int for column in players.columns if column.startswith("star_")})
+        increment_columns(cur, "players", "id", players)
+        increment_columns(cur, "teams", "name", new_teams.sub(old_teams, fill_value=0).astype(float))
+
+
+def rebuild_aggregates():
+    """Rebuild the whole contribution ledger and every player and team aggregate from it in one transaction
+
+    Resetting and incrementing the counters share the transaction, so a failed run leaves them untouched and the
+    counters always match the ledger that update_aggregates later applies deltas against. It aggregates the stored
+    tackle_probabilities, so run score_tackle_probabilities first after retraining the model.
+    """
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE players SET tackles_above_expected=0, " +
+                    ", ".join("star_{0}_made=0, star_{0}_missed=0".format(i) for i in range(1, 6)))
+        cur.execute("UPDATE teams SET tackles_above_expected=0")
+        players, teams = aggregate_contributions(refresh_contributions(cur)[1])
+        increment_columns(cur, "players", "id", players)
+        increment_columns(cur, "teams", "name", teams)
 
 
 def calculate_vector(magnitude: float, degrees: float):
@@ -106,119 +218,14 @@ def calculate_vector(magnitude: float, degrees: float):
     return [magnitude * math.cos(rads), magnitude * math.sin(rads)]
 
 
-def expected_tackles():
-    """Calculate expected tackles"""
-    model = load("model.joblib")
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET tackles_above_expected=0")
-    cur.execute("UPDATE teams SET tackles_above_expected=0")
-    cur.execute("SELECT game_id, play_id, ball_carrier FROM plays")
-    plays = cur.fetchall()
-    for play in plays:
-        cur.execute("SELECT x, y, lr, team FROM tracking WHERE game_id=%s AND play_id=%s AND player_id=%s "
-                    "AND event='pass_arrived'", play)
-        ball_carrier = cur.fetchone()
-        if ball_carrier is None:  # This means that the play is not a passing play
-            continue
-        # Get tackler data
-        cur.execute("SELECT player_id, x, y, speed, acceleration, team FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id "
-                    "IN (SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s AND (tackle='t' OR assist='t')) "
-                    "AND event='pass_arrived'", list(play[:2]) + [ball_carrier[3]] + list(play[:2]))
-        tacklers = cur.fetchall()
-        # Get non-tackler data
-        cur.execute("SELECT player_id, x, y, speed, acceleration, team FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id "
-                    "NOT IN (SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s AND (tackle='t' OR assist='t')) "
-                    "AND event='pass_arrived'", list(play[:2]) + [ball_carrier[3]] + list(play[:2]))
-        non_tacklers = cur.fetchall()
-        # Calculate model features for tacklers and non-tacklers
-        tacklers_x = [[math.sqrt(abs(ball_carrier[1] - tackler[2])),
-                       math.sqrt(math.sqrt((ball_carrier[0] - tackler[1]) ** 2 + (ball_carrier[1] - tackler[2]) ** 2)),
-                       tackler[3], tackler[4]]
-                      for tackler in tacklers]
-        non_tacklers_x = [[math.sqrt(abs(ball_carrier[1] - tackler[2])),
-                           math.sqrt(math.sqrt((ball_carrier[0] - tackler[1]) ** 2 + (ball_carrier[1] - tackler[2]) ** 2)),
-                           tackler[3], tackler[4]]
-                          for tackler in non_tacklers]
-        tackler_probability = model.predict_proba(tacklers_x) if tacklers_x else []
-        non_tackler_probability = model.predict_proba(non_tacklers_x)
-        # Create dicts to map tackler and non-tackler ids to their tackle probability
-        tp, ntp = {}, {}
-        for i, tackler in enumerate(tackler_probability):
-            tp[tacklers[i][0]] = tackler[1]
-        for i, tackler in enumerate(non_tackler_probability):
-            ntp[non_tacklers[i][0]] = tackler[1]
-        ntp = dict(sorted(ntp.items(), key=lambda item: -item[1]))
-        # If there was no tackle made on the play, assign the missed tackle to the player with the highest probability
-        if not tacklers:
-            for nt in ntp:
-                cur.execute("UPDATE players SET tackles_above_expected=tackles_above_expected-%s WHERE id=%s",
-                            (ntp.get(nt), nt))
-                cur.execute("UPDATE teams SET tackles_above_expected=tackles_above_expected-%s WHERE name=%s",
-                            (ntp.get(nt), non_tacklers[0][5]))
-                break
-        else:
-            # Increment the TAA of each tackler
-            for t in tp:
-                cur.execute("UPDATE players SET tackles_above_expected=tackles_above_expected+%s WHERE id=%s",
-                            (1 - tp.get(t), t))
-                cur.execute("UPDATE teams SET tackles_above_expected=tackles_above_expected+%s WHERE name=%s",
-                            (1 - tp.get(t), non_tacklers[0][5]))
-            # Decrement the TAA of each non-tackler with a tackle probability
-            # of at least 25% higher than the highest tackler
-            for nt in ntp:
-                if ntp.get(nt) < max(tp.values()) + 0.25:
-                    break
-                cur.execute("UPDATE players SET tackles_above_expected=tackles_above_expected-%s WHERE id=%s",
-                            (ntp.get(nt), nt))
-                cur.execute("UPDATE teams SET tackles_above_expected=tackles_above_expected-%s WHERE name=%s",
-                            (ntp.get(nt), non_tacklers[0][5]))
-    conn.commit()
-    conn.close()
-
-
 def generate_model():
     """Generate the Logistic Regression model used to determine tackle probability"""
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
-    cur.execute("SELECT game_id, play_id, ball_carrier FROM plays")
-    plays = cur.fetchall()
-    lateral = [[], []]
-    distance = [[], []]
-    speed = [[], []]
-    acceleration = [[], []]
-    players = [[], []]
-    for play in plays:
-        cur.execute("SELECT x, y, team, speed_x, speed_y FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND player_id=%s AND event='pass_arrived'", play)
-        ball_carrier = cur.fetchone()
-        if ball_carrier is None:  # This implies that it is not a passing play
-            continue
-        # Get tackler and non-tackler data
-        cur.execute("SELECT x, y, speed, acceleration FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id IN "
-                    "(SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s AND (tackle='t' OR assist='t')) "
-                    "AND event='pass_arrived'", list(play[:2]) + [ball_carrier[2]] + list(play[:2]))
-        players[0] = cur.fetchall()
-        cur.execute("SELECT x, y, speed, acceleration FROM tracking WHERE game_id=%s AND play_id=%s AND team!=%s AND team!='FB' AND player_id NOT IN "
-                    "(SELECT player_id FROM tackles WHERE game_id=%s AND play_id=%s AND (tackle='t' OR assist='t')) "
-                    "AND event='pass_arrived'", list(play[:2]) + [ball_carrier[2]] + list(play[:2]))
-        players[1] = cur.fetchall()
-        np.seterr(all="raise")  # Raise all warnings as errors
-        # Calculate the data for each player
-        for i in range(2):
-            for player in players[i]:
-                lateral[i].append(math.sqrt(abs(ball_carrier[1] - player[1])))
-                distance[i].append(math.sqrt(math.sqrt((ball_carrier[0] - player[0]) ** 2
-                                                       + (ball_carrier[1] - player[1]) ** 2)))
-                speed[i].append(player[2])
-                acceleration[i].append(player[3])
-    # Convert the calculated variables to the format needed for the LogisticRegression model
-    x = [i for i in zip(lateral[0] + lateral[1], distance[0] + distance[1], speed[0] + speed[1],
-                        acceleration[0] + acceleration[1])]
-    y = [1] * len(distance[0]) + [0] * len(distance[1])
+    data = np.concatenate([np.array([defender[4:] for defender in defenders], dtype=np.float64)
+                           for defenders in catch_defender_chunks()])
+    np.seterr(all="raise")  # Raise all warnings as errors
+    # The snapshot already holds the data for each player in the format needed for the LogisticRegression model
+    x = data[:, :4]
+    y = data[:, 4].astype(int)
     model = LogisticRegression(class_weight="balanced").fit(x, y)
     print(model.score(x, y))  # This is an F1-score
     print(model.coef_, model.intercept_)
@@ -226,5 +233,7 @@ def generate_model():
 
 
 if __name__ == "__main__":
-    star_tackles_missed()
-    star_tackles_made()
+    score_tackle_probabilities()
+    # The player and team aggregates live in the database, so the parquet backend only scores
+    if storage.backend != "parquet":
+        rebuild_aggregates()
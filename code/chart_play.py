@@ -1,25 +1,33 @@
-from joblib import load
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import suppress
+import csv
+from functools import lru_cache
 import numpy as np
 import matplotlib.patches as patches
 from matplotlib.markers import MarkerStyle
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import math
-import psycopg2
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+import multiprocessing
 from sys import argv
 import os
-from dotenv import load_dotenv
+import subprocess
+import time
 from matplotlib.patches import Patch
-load_dotenv()
-connection_string = os.environ["connection_string"]
+from db import connect
+from models import load_model
+from features import tackle_features
+import storage
+from storage import PLAY_FIELDS, lookup, play_index_rows
 
 
 def create_football_field(fig, ax, line_color='white', field_color='green'):
     """Function that plots the football field for viewing players."""
 
     # set field dimensions
-    plt.xlim(0, 120)
-    plt.ylim(0, 53.3)
+    ax.set_xlim(0, 120)
+    ax.set_ylim(0, 53.3)
 
     # adding rectangles to the field
     for i in range(12):
@@ -59,169 +67,404 @@ def create_football_field(fig, ax, line_color='white', field_color='green'):
     return fig, ax
 
 
+@lru_cache(maxsize=16)
+def field_raster(size: tuple, dpi: float, line_color: str = 'white', field_color: str = 'green'):
+    """Render the football field's data area once per axes size (in inches), dpi and colours into an RGBA array"""
+    fig = Figure(figsize=size, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    # The field's ticks and yard labels sit inside the axes, so an axes filling the figure holds the whole field
+    create_football_field(fig, fig.add_axes([0, 0, 1, 1]), line_color, field_color)
+    canvas.draw()
+    raster = np.array(canvas.buffer_rgba())
+    raster.flags.writeable = False  # The cached raster is shared by every figure of this size
+    return raster
+
+
+def cached_football_field(fig, ax, line_color='white', field_color='green'):
+    """Draw the cached field raster in ax's data coordinates instead of rebuilding its patches and tick labels"""
+    size = tuple(ax.get_position().size * fig.get_size_inches())
+    # The image is placed by its extent, so it stays lined up with the players at any dpi or window size
+    ax.imshow(field_raster(size, fig.dpi, line_color, field_color), extent=(0, 120, 0, 53.3), aspect="auto",
+              zorder=-1)
+    ax.set_xlim(0, 120)
+    ax.set_ylim(0, 53.3)
+    ax.axis("off")
+    return fig, ax
+
+
 def visualize_frame(game_id: int, play_id: int, home_color: str = 'cornflowerblue', away_color: str = 'coral'):
     """Visualize the crucial frame for a play"""
-    model = load("distance.joblib")
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
-    fig, ax = plt.subplots(figsize=(12, 5.33))
-    ax.clear()
-    create_football_field(fig, ax)
-
-    cur.execute("SELECT defensive_team FROM plays WHERE game_id=%s AND play_id=%s", (game_id, play_id))
-    defensive_team = cur.fetchone()[0]
-
-    cur.execute("SELECT player_id, team, orientation, x, y, speed, acceleration FROM tracking "
-                "WHERE game_id=%s AND play_id=%s AND event='pass_arrived'", (game_id, play_id))
-    step_info = cur.fetchall()
-    cur.execute("SELECT x, y, lr FROM tracking t, plays p "
-                "WHERE t.game_id=%s AND p.game_id=%s AND t.play_id=%s AND p.play_id=%s AND t.player_id=p.ball_carrier "
-                "AND event='pass_arrived'",
-                (game_id, game_id, play_id, play_id))
-    ball_carrier = cur.fetchone()
-    data = []
-    for row in step_info:
-        data.append([math.sqrt(abs(ball_carrier[1] - row[4])),  # Sqrt of lateral distance
-                     math.sqrt(math.sqrt((ball_carrier[0] - row[3]) ** 2 + (ball_carrier[1] - row[4]) ** 2)),  # Sqrt of euclidean distance
-                     row[5], row[6]])  # Speed and acceleration
-    probabilities = model.predict_proba(data)
-
-    # iterate step info to populate field
-    home_team = None
-    for i, row in enumerate(step_info):
-        if row[0] == 1:
-            color = "saddlebrown"
-            ax.scatter(row[3], row[4], marker="d", s=100, color=color)
-            continue
-        if home_team is None:
-            home_team = row[1]
-        if row[1] == home_team:
-            color = home_color
-        else:
-            color = away_color
-        marker1 = MarkerStyle(r'$\spadesuit$')
-        marker1._transform.rotate_deg(360 - row[2])
-        if row[1] == defensive_team:
-            ax.scatter(row[3], row[4], marker=marker1, s=150, color=color,
-                       label="{0} - {1}".format(row[0] % 100, probabilities[i][1]), zorder=3)
-            ax.text(row[3], row[4], str(row[0] % 100))
-        else:
-            ax.scatter(row[3], row[4], marker=marker1, s=150, color=color, zorder=2)
+    model, _ = load_model("distance.joblib")
+    with connect() as conn:
+        cur = conn.cursor()
+        fig, ax = plt.subplots(figsize=(12, 5.33))
+        ax.clear()
+        cached_football_field(fig, ax)
+
+        cur.execute("SELECT player_id, team, orientation, x, y, sqrt_lateral, sqrt_distance, speed, acceleration, "
+                    "defender FROM catch_snapshots WHERE game_id=%s AND play_id=%s", (game_id, play_id))
+        step_info = cur.fetchall()
+        probabilities = model.predict_proba([row[5:9] for row in step_info])
 
-    # set axis title
-    ax.set_title(f'Tracking data for {game_id} {play_id}')
-    ax.legend()
-    plt.savefig("play.png")
-    conn.close()
+        # iterate step info to populate field
+        home_team = None
+        for i, row in enumerate(step_info):
+            if row[0] == 1:
+                color = "saddlebrown"
+                ax.scatter(row[3], row[4], marker="d", s=100, color=color)
+                continue
+            if home_team is None:
+                home_team = row[1]
+            if row[1] == home_team:
+                color = home_color
+            else:
+                color = away_color
+            marker1 = MarkerStyle(r'$\spadesuit$')
+            marker1._transform.rotate_deg(360 - row[2])
+            if row[9]:  # Defenders are labelled with their tackle probability
+                ax.scatter(row[3], row[4], marker=marker1, s=150, color=color,
+                           label="{0} - {1}".format(row[0] % 100, probabilities[i][1]), zorder=3)
+                ax.text(row[3], row[4], str(row[0] % 100))
+            else:
+                ax.scatter(row[3], row[4], marker=marker1, s=150, color=color, zorder=2)
 
+        # set axis title
+        ax.set_title(f'Tracking data for {game_id} {play_id}')
+        ax.legend()
+        plt.savefig("play.png")
+
+
+def render_frames(fig, artists: list, update, frames: int):
+    """Yield each frame's RGBA buffer, drawing the static background once and only the updated artists per frame"""
+    canvas = FigureCanvasAgg(fig)
+    for artist in artists:
+        artist.set_animated(True)  # Keep the moving artists out of the cached background
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    for i in range(frames):
+        canvas.restore_region(background)
+        for artist in sorted(update(i), key=lambda artist: artist.get_zorder()):
+            fig.draw_artist(artist)
+        yield canvas.buffer_rgba()
+
+
+def save_gif(fig, artists: list, update, frames: int, path: str, fps: int = 10):
+    """Render the frames with render_frames and write them to a GIF in-process with Pillow"""
+    images = (Image.fromarray(np.asarray(buffer)).convert("RGB")
+              for buffer in render_frames(fig, artists, update, frames))
+    first = next(images)
+    first.save(path, save_all=True, append_images=images, duration=int(1000 / fps), loop=0)
+
+
+# ffmpeg output arguments per container. yuv420p needs even dimensions, so odd figure sizes are padded by a pixel
+FFMPEG_CODECS = {
+    "mp4": ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-movflags", "+faststart"],
+    "webm": ["-c:v", "libvpx-vp9", "-b:v", "0", "-crf", "32", "-deadline", "realtime", "-cpu-used", "8"],
+}
+
+
+def save_video(fig, artists: list, update, frames: int, path: str, fps: int = 10):
+    """Render the frames with render_frames and pipe their raw RGBA buffers straight into ffmpeg"""
+    encoder = None
+    try:
+        for buffer in render_frames(fig, artists, update, frames):
+            if encoder is None:
+                # Size the video from the rendered buffer, as render_frames draws on its own canvas
+                height, width = np.asarray(buffer).shape[:2]
+                command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgba",
+                           "-s", "{0}x{1}".format(width, height), "-r", str(fps), "-i", "-",
+                           "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+                command += FFMPEG_CODECS[os.path.splitext(path)[1][1:]] + [path]
+                encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+            encoder.stdin.write(buffer)
+    except BaseException:
+        # Let the rendering error, or the BrokenPipeError of an ffmpeg that exited early, propagate unmasked
+        if encoder is not None:
+            with suppress(OSError):
+                encoder.stdin.close()
+            encoder.wait()
+        raise
+    encoder.stdin.close()
+    if encoder.wait():
+        raise RuntimeError("ffmpeg exited with status {0} writing {1}".format(encoder.returncode, path))
+
+
+# Writer backends by output extension
+WRITERS = {"gif": save_gif, "mp4": save_video, "webm": save_video}
+
+
+def save_animation(fig, artists: list, update, frames: int, out: str, writer: str = "gif", fps: int = 10):
+    """Write the animation to out.<writer> with that writer's backend, reporting the output size and encode time"""
+    path = "{0}.{1}".format(out, writer)
+    start = time.perf_counter()
+    WRITERS[writer](fig, artists, update, frames, path, fps=fps)
+    elapsed = time.perf_counter() - start
+    print("{0}: {1:.0f} KiB in {2:.2f} s".format(path, os.path.getsize(path) / 1024, elapsed))
+    return path
+
+
+def load_play(game_id: int, play_id: int):
+    """Load a play's tracking once into a frames x players x PLAY_FIELDS array so frames are plain array slices"""
+    if storage.backend == "parquet":
+        # Slice the play straight out of the memory-mapped play index instead of querying tracking
+        rows = play_index_rows(game_id, play_id)
+        columns = [rows["frame_id"], rows["player_id"], rows["team"], rows["jersey_number"], rows["event"]]
+        data = rows["data"]
+    else:
+        with connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT frame_id, player_id, team, jerseynumber, event, " + ", ".join(PLAY_FIELDS) +
+                        " FROM tracking WHERE game_id=%s AND play_id=%s ORDER BY frame_id", (game_id, play_id))
+            rows = cur.fetchall()
+        columns = list(zip(*rows))
+        data = np.array([row[5:] for row in rows], dtype=np.float64)
+    frame_ids, frame_index = np.unique(np.array(columns[0]), return_inverse=True)
+    # Keep players in the order they first appear, which decides the home team colours
+    player_ids, first_seen, player_index = np.unique(np.array(columns[1]), return_index=True, return_inverse=True)
+    order = np.argsort(first_seen)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    play_data = np.full((len(frame_ids), len(player_ids), len(PLAY_FIELDS)), np.nan)
+    play_data[frame_index, rank[player_index]] = data
+    events = np.full(len(frame_ids), None, dtype=object)
+    events[frame_index] = columns[4]
+    return {"frame_ids": frame_ids, "player_ids": player_ids[order],
+            "teams": np.array(columns[2], dtype=object)[first_seen[order]],
+            "jersey_numbers": np.array(columns[3], dtype=np.float64)[first_seen[order]],
+            "events": events, "data": play_data}
+
+
+def play_frame(play: dict, frame_id: int):
+    """Get the players x PLAY_FIELDS slice of a loaded play for a frame_id"""
+    return play["data"][np.searchsorted(play["frame_ids"], frame_id)]
+
+
+def play_probabilities(play: dict, ball_carrier: int, model):
+    """Score every defender on every frame of a loaded play with one predict_proba call
+
+    Returns the defenders' player_ids and a frames x defenders array of tackle probabilities, NaN where the
+    defender or ball carrier isn't tracked.
+    """
+    carrier = play["player_ids"] == ball_carrier
+    defenders = (play["teams"] != play["teams"][carrier][0]) & (play["teams"] != "FB")
+    fields = [PLAY_FIELDS.index(field) for field in ["x", "y", "speed", "acceleration"]]
+    defender_data = play["data"][:, defenders][:, :, fields].reshape(-1, 4)
+    carrier_xy = np.repeat(play["data"][:, carrier, :2].reshape(-1, 2), defenders.sum(), axis=0)
+    tracked = ~np.isnan(defender_data).any(axis=1) & ~np.isnan(carrier_xy).any(axis=1)
+    probabilities = np.full(len(defender_data), np.nan)
+    if tracked.any():
+        probabilities[tracked] = model.predict_proba(tackle_features(carrier_xy[tracked], defender_data[tracked]))[:, 1]
+    return play["player_ids"][defenders], probabilities.reshape(len(play["frame_ids"]), -1)
+
+
+def probability_timeline(game_id: int, play_id: int):
+    """Load a play and its frames x defenders tackle probabilities, cached so the GIF and chart share one load"""
+    # A new version of the model is a new object, so it never reuses timelines scored by the old one
+    return scored_play(game_id, play_id, load_model("distance.joblib")[0])
+
+
+@lru_cache(maxsize=32)
+def scored_play(game_id: int, play_id: int, model):
+    """Load a play and score it with play_probabilities"""
+    play = load_play(game_id, play_id)
+    ball_carrier = lookup("plays", "ball_carrier", game_id=game_id, play_id=play_id)
+    defender_ids, probabilities = play_probabilities(play, ball_carrier, model)
+    return play, defender_ids, probabilities
+
+
+def chart_probabilities(game_id: int, play_id: int, out: str):
+    """Plot every defender's tackle probability against time on the play and save it to out.png"""
+    play, defender_ids, probabilities = probability_timeline(game_id, play_id)
+    seconds = (play["frame_ids"] - play["frame_ids"][0]) / 10  # Tracking is sampled at 10 frames per second
+    fig, ax = plt.subplots(figsize=(12, 5.33))
+    jersey_numbers = dict(zip(play["player_ids"], play["jersey_numbers"]))
+    for defender_id, column in zip(defender_ids, probabilities.T):
+        ax.plot(seconds, column * 100, label="#{0:.0f}".format(jersey_numbers[defender_id]))
+    pass_arrived = seconds[play["events"] == "pass_arrived"]
+    if len(pass_arrived):
+        ax.axvline(pass_arrived[0], color="black", linestyle="--", label="Pass arrived")
+    ax.set_xlabel("Seconds")
+    ax.set_ylabel("Tackle Probability (%)")
+    ax.set_ylim(0, 100)
+    ax.set_title(play_title(game_id, play_id), fontsize=14, fontweight='bold')
+    ax.legend(loc='upper left', ncol=2, fontsize=8)
+    fig.savefig("{0}.png".format(out), bbox_inches="tight")
+    plt.close(fig)
+    return "{0}.png".format(out)
+
+
+def visualize_play(game_id: int, play_id: int, title_str: str, player_id: int, out: str,
+                   home_color: str = 'royalblue', away_color: str = 'black', home_text_color: str = 'yellow',
+                   away_text_color: str = 'white', writer: str = "gif"):
+    """Visualize a play from the dataset, writing it to out with the given WRITERS backend"""
+    play, defender_ids, probabilities = probability_timeline(game_id, play_id)
+    name = lookup("players", "name", id=player_id)
+    # The focused player's probability on each frame, or NaN throughout if they aren't a defender
+    focus_probabilities = (probabilities[:, defender_ids == player_id][:, 0] if (defender_ids == player_id).any()
+                           else np.full(len(play["frame_ids"]), np.nan))
 
-def visualize_play(game_id: int, play_id: int, title_str: str):
-    """Visualize a play from the dataset"""
-    model = load("distance.joblib")
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
     # Get max frame_id to find total length of the play
-    cur.execute("SELECT MAX(frame_id) FROM tracking WHERE game_id=%s AND play_id=%s", (game_id, play_id))
-    max_step = cur.fetchone()[0]
+    max_step = int(play["frame_ids"][-1])
     frame_mod = 2
     og_frames = max_step // frame_mod
-    interval_ms = 100 * frame_mod
     fig, ax = plt.subplots(figsize=(12, 5.33))
 
     # Find the frame_id of when the pass arrived
-    cur.execute("SELECT frame_id FROM tracking WHERE game_id=%s AND play_id=%s AND event LIKE 'pass_arrived'",
-                (game_id, play_id))
-    pass_arrived_frame = cur.fetchone()[0] if cur.rowcount != 0 else None
+    pass_arrived = play["frame_ids"][play["events"] == "pass_arrived"]
+    pass_arrived_frame = int(pass_arrived[0]) if len(pass_arrived) else None
 
     pause_duration_frames = 10
 
     # Increase the total number of frames to include the pause
     frames = og_frames + pause_duration_frames
     step_list = np.linspace(1, max_step, frames)
-
-    cur.execute("SELECT player_id, team, orientation, x, y, speed, acceleration, p.name FROM tracking, players p "
-                "WHERE player_id=%s AND game_id=%s AND play_id=%s AND event='pass_arrived' AND player_id=p.id",
-                (argv[4], game_id, play_id))
-    tackler = cur.fetchone()
-    cur.execute("SELECT x, y, lr FROM tracking t, plays p "
-                "WHERE t.game_id=%s AND p.game_id=%s AND t.play_id=%s AND p.play_id=%s AND t.player_id=p.ball_carrier "
-                "AND event='pass_arrived'",
-                (game_id, game_id, play_id, play_id))
-    ball_carrier = cur.fetchone()
-    # Repeat the data used to train the model
-    data = [[math.sqrt(abs(ball_carrier[1] - tackler[4])),
-             math.sqrt(math.sqrt((ball_carrier[0] - tackler[3]) ** 2 + (ball_carrier[1] - tackler[4]) ** 2)),
-             tackler[5], tackler[6]]]
-    probability = model.predict_proba(data)[0]
-
-    def animate(i: int, game_id: int, play_id: int, frames: int, home_color: str = 'royalblue',
-                away_color: str = 'black', home_text_color: str = 'yellow', away_text_color: str = 'white'):
+    home_team = next(team for team in play["teams"] if team != "FB")
+    football = play["player_ids"] == 1
+    home = (play["teams"] == home_team) & ~football
+    away = ~home & ~football
+    focus = play["player_ids"] == player_id
+
+    # Draw the field and title once; frames only move the player artists
+    cached_football_field(fig, ax)
+    home_patch = Patch(color=home_color, label=f'Home Team: Los Angeles Rams')
+    away_patch = Patch(color=away_color, label=f'Away Team: Atlanta Falcons')
+    legend = ax.legend(handles=[home_patch, away_patch],
+                   loc='upper left', frameon=True, handlelength=0, handletextpad=0)
+    legend.get_frame().set_facecolor('lightgray')  # Set the legend background color
+    legend.get_frame().set_edgecolor('black')  # Optionally, set the legend border color
+    legend.get_frame().set_alpha(0.8)  # Optionally, set the transparency of the background
+    ax.set_title(f"{title_str}", fontsize=14, fontweight='bold')
+
+    # One scatter per team, one text per jersey number, and the focus circle and annotation shown during the pause.
+    # These are the only artists redrawn on each frame
+    home_scatter = ax.scatter([], [], marker='o', s=150, color=home_color, zorder=3)
+    away_scatter = ax.scatter([], [], marker='o', s=150, color=away_color, zorder=2)
+    football_scatter = ax.scatter([], [], marker="d", s=100, color="saddlebrown", zorder=4)
+    numbers = [ax.text(0, 0, "" if is_football else str(int(jersey_number)),
+                       color=home_text_color if is_home else away_text_color,
+                       fontsize=8, ha='center', va='center', zorder=5, visible=False)
+               for jersey_number, is_home, is_football in zip(play["jersey_numbers"], home, football)]
+    circle = plt.Circle((0, 0), 1.5, color='yellow', fill=False, lw=2, visible=False)
+    ax.add_patch(circle)
+    annotation = ax.annotate("",
+                             xy=(0, 0), xycoords='data',
+                             xytext=(0.75, 0.83), textcoords='axes fraction',
+                             arrowprops=dict(arrowstyle="->", connectionstyle="arc3"),
+                             bbox=dict(boxstyle="round,pad=0.5", facecolor='wheat', edgecolor='black', alpha=0.5),
+                             fontsize=12, visible=False)
+    # The legend is redrawn after the players each frame so it stays on top of them, as it was before blitting
+    artists = [home_scatter, away_scatter, football_scatter, circle, annotation] + numbers + [legend]
+
+    def animate(i: int):
         """Function to animate player tracking data"""
-        ax.clear()
-        create_football_field(fig, ax)
-
-        home_patch = Patch(color=home_color, label=f'Home Team: Los Angeles Rams')
-        away_patch = Patch(color=away_color, label=f'Away Team: Atlanta Falcons')
-
-        legend = ax.legend(handles=[home_patch, away_patch],
-                       loc='upper left', frameon=True, handlelength=0, handletextpad=0)
-        legend.get_frame().set_facecolor('lightgray')  # Set the legend background color
-        legend.get_frame().set_edgecolor('black')  # Optionally, set the legend border color
-        legend.get_frame().set_alpha(0.8)  # Optionally, set the transparency of the background
-        if pass_arrived_frame and pass_arrived_frame <= i <= pass_arrived_frame + pause_duration_frames:
-
-            cur.execute("SELECT player_id, team, orientation, x, y, speed_x, speed_y, acc_x, acc_y, jerseynumber FROM tracking "
-                        "WHERE game_id=%s AND play_id=%s AND frame_id=%s", (game_id, play_id, pass_arrived_frame))
-            paused_step_info = cur.fetchall()
-            home_team = None
-            for row in paused_step_info:
-                if row[0] == 1:
-                    color = "saddlebrown"
-                    ax.scatter(row[3], row[4], marker="d", s=100, color=color)
-                    continue
-                if home_team is None:
-                    home_team = row[1]
-                if row[1] == home_team:
-                    color = home_color
-                    text_color = home_text_color
-                    player_zorder = 3
-                else:
-                    color = away_color
-                    text_color = away_text_color
-                    player_zorder = 2
-                marker1 = MarkerStyle(r'o')
-                marker1._transform.rotate_deg(360 - row[2])
-                ax.scatter(row[3], row[4], marker=marker1, s=150, color=color, zorder = player_zorder)
-                player_number = str(int(row[9]))
-                ax.text(row[3], row[4], player_number, color = text_color, fontsize = 8, ha = 'center', va = 'center')
-
-                if row[0] == int(argv[4]):  # If the current player is the "focused" player
-                    circle = plt.Circle((row[3], row[4]), 1.5, color='yellow', fill=False, lw=2)
-                    ax.add_patch(circle)
-                    textstr = f"{tackler[-1]}: Tackle Probability: {round(probability[1] * 100, 2)}%"
-                    ax.annotate(textstr,
-                            xy=(row[3], row[4]), xycoords='data',
-                            xytext=(0.75, 0.83), textcoords='axes fraction',
-                            arrowprops=dict(arrowstyle="->", connectionstyle="arc3"),
-                            bbox=dict(boxstyle="round,pad=0.5", facecolor='wheat', edgecolor='black', alpha=0.5),
-                            fontsize=12)
-            ax.set_title(f"{title_str}", fontsize=14, fontweight='bold')
-            return
-
-        if i > (pass_arrived_frame + pause_duration_frames):
-            i -= pause_duration_frames
+        paused = bool(pass_arrived_frame) and pass_arrived_frame <= i <= pass_arrived_frame + pause_duration_frames
+        if paused:
+            step = pass_arrived_frame
+        else:
+            if pass_arrived_frame and i > (pass_arrived_frame + pause_duration_frames):
+                i -= pause_duration_frames
+            step = int(step_list[i])
+
+        step_info = play_frame(play, step)
+        tracked = ~np.isnan(step_info[:, 0])  # Players that aren't tracked on this frame are hidden
+        home_scatter.set_offsets(step_info[home & tracked, :2])
+        away_scatter.set_offsets(step_info[away & tracked, :2])
+        football_scatter.set_offsets(step_info[football & tracked, :2])
+        for number, row, is_tracked, is_football in zip(numbers, step_info, tracked, football):
+            number.set_visible(bool(is_tracked and not is_football))
+            if is_tracked:
+                number.set_position(row[:2])
+
+        # Highlight the "focused" player with their tackle probability on this frame
+        focus_row = step_info[focus & tracked]
+        probability = focus_probabilities[np.searchsorted(play["frame_ids"], step)]
+        show_focus = len(focus_row) > 0 and not np.isnan(probability)
+        circle.set_visible(show_focus)
+        annotation.set_visible(show_focus)
+        if show_focus:
+            circle.center = tuple(focus_row[0, :2])
+            annotation.xy = tuple(focus_row[0, :2])
+            annotation.set_text(f"{name}: Tackle Probability: {round(probability * 100, 2)}%")
+        return artists
+
+    path = save_animation(fig, artists, animate, frames, out, writer, fps=10)
+    plt.close(fig)
+    return path
+
+
+def play_title(game_id: int, play_id: int):
+    """Get the play description used as the title of a play's GIF"""
+    play_description = lookup("plays", "play", game_id=game_id, play_id=play_id)
+    play_description = play_description.split(")")[2][1:]
+    return play_description.split("(")[0][:-1]
+
+
+def render_job(job: tuple):
+    """Render a (game_id, play_id, player_id, out) job unless its GIF was rendered with the current model version"""
+    game_id, play_id, player_id, out = job
+    path, stamp = "{0}.gif".format(out), "{0}.version".format(out)
+    _, version = load_model("distance.joblib")
+    if os.path.exists(path) and os.path.exists(stamp):
+        with open(stamp) as f:
+            if f.read() == version:
+                return path, False
+    visualize_play(game_id, play_id, play_title(game_id, play_id), player_id, out)
+    with open(stamp, "w") as f:
+        f.write(version)
+    return path, True
+
+
+def read_jobs(path: str):
+    """Read game_id, play_id, player_id, out jobs from a CSV file with a header row"""
+    with open(path, newline="") as f:
+        return [(int(row["game_id"]), int(row["play_id"]), int(row["player_id"]), row["out"])
+                for row in csv.DictReader(f)]
+
+
+def top_taa_jobs(limit: int):
+    """Make a job for each of the plays with the largest tackles above expected contributions"""
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT game_id, play_id, player_id FROM tackle_contributions "
+                    "ORDER BY tackles_above_expected DESC LIMIT %s", (limit,))
+        return [(game_id, play_id, player_id, "{0}_{1}_{2}".format(game_id, play_id, player_id))
+                for game_id, play_id, player_id in cur.fetchall()]
+
+
+def render_batch(jobs: list, workers: int = os.cpu_count()):
+    """Render many play GIFs in parallel and return the jobs that failed; each worker uses its own pooled connection"""
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(render_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                path, rendered = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Failed to render {futures[future]}: {e}")
+                continue
+            print(f"{'Rendered' if rendered else 'Skipped up to date'} {path}")
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} jobs failed")
+    return failed
+
 
+def visualize_speed(game_id: int, play_id: int, home_color: str = "cornflowerblue", away_color: str = "coral"):
+    """Visualize speed vectors for a play"""
+    with connect() as conn:
+        cur = conn.cursor()
+        fig, ax = plt.subplots(figsize=(12, 5.33))
         # create fresh field
-        step = int(step_list[i])
+        ax.clear()
+        cached_football_field(fig, ax)
 
-        # subset data to step info
-        cur.execute("SELECT player_id, team, orientation, x, y, speed_x, speed_y, acc_x, acc_y, jerseynumber FROM tracking "
-                    "WHERE game_id=%s AND play_id=%s AND frame_id=%s", (game_id, play_id, step))
-        step_info = cur.fetchall()
+        cur.execute("SELECT player_id, team, orientation, x, y, speed_x, speed_y FROM tracking "
+                    "WHERE game_id=%s AND play_id=%s AND event='handoff'", (game_id, play_id))
+        info = cur.fetchall()
 
         # iterate step info to populate field
         home_team = None
-        for row in step_info:
+        for row in info:
             if row[0] == 1:
                 color = "saddlebrown"
                 ax.scatter(row[3], row[4], marker="d", s=100, color=color)
@@ -230,73 +473,31 @@ def visualize_play(game_id: int, play_id: int, title_str: str):
                 home_team = row[1]
             if row[1] == home_team:
                 color = home_color
-                text_color = home_text_color
-                player_zorder = 3
             else:
                 color = away_color
-                text_color = away_text_color
-                player_zorder = 2
-            marker1 = MarkerStyle(r'o')
+            marker1 = MarkerStyle(r'$\spadesuit$')
             marker1._transform.rotate_deg(360 - row[2])
-            ax.scatter(row[3], row[4], marker=marker1, s=150, color=color, zorder = player_zorder)
-            player_number = str(int(row[9]))
-            ax.text(row[3], row[4], player_number, color = text_color, fontsize = 8, ha = 'center', va = 'center')
+            ax.scatter(row[3], row[4], marker=marker1, s=150, color=color)
+            ax.arrow(row[3], row[4], row[5], row[6], color="firebrick", width=0.25)
 
         # set axis title
-        ax.set_title(f"{title_str}", fontsize=14, fontweight='bold')
-
-    anim = animation.FuncAnimation(fig, animate, fargs=(game_id, play_id, frames), frames=frames, repeat=False,
-                                   interval=interval_ms)
-    anim.save("{0}.gif".format(argv[5]), writer="imagemagick", fps=10)
-    conn.close()
-
-
-def visualize_speed(game_id: int, play_id: int, home_color: str = "cornflowerblue", away_color: str = "coral"):
-    """Visualize speed vectors for a play"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    fig, ax = plt.subplots(figsize=(12, 5.33))
-    # create fresh field
-    ax.clear()
-    create_football_field(fig, ax)
-
-    cur.execute("SELECT player_id, team, orientation, x, y, speed_x, speed_y FROM tracking "
-                "WHERE game_id=%s AND play_id=%s AND event='handoff'", (game_id, play_id))
-    info = cur.fetchall()
-
-    # iterate step info to populate field
-    home_team = None
-    for row in info:
-        if row[0] == 1:
-            color = "saddlebrown"
-            ax.scatter(row[3], row[4], marker="d", s=100, color=color)
-            continue
-        if home_team is None:
-            home_team = row[1]
-        if row[1] == home_team:
-            color = home_color
-        else:
-            color = away_color
-        marker1 = MarkerStyle(r'$\spadesuit$')
-        marker1._transform.rotate_deg(360 - row[2])
-        ax.scatter(row[3], row[4], marker=marker1, s=150, color=color)
-        ax.arrow(row[3], row[4], row[5], row[6], color="firebrick", width=0.25)
-
-    # set axis title
-    ax.set_title(f'Tracking data for {game_id} {play_id}')
-    plt.show()
+        ax.set_title(f'Tracking data for {game_id} {play_id}')
+        plt.show()
 
 
 if __name__ == "__main__":
     if argv[1] == "-p":
-        # Get the play description before calling the function
-        conn = psycopg2.connect(connection_string)
-        cur = conn.cursor()
-        cur.execute("SELECT play FROM plays WHERE game_id=%s AND play_id=%s", (argv[2], argv[3]))
-        play_description = cur.fetchone()[0]
-        play_description = play_description.split(")")[2][1:]
-        play_description = play_description.split("(")[0][:-1]
-        # Visualize the play
-        visualize_play(int(argv[2]), int(argv[3]), play_description)
+        # Visualize the play: -p game_id play_id player_id out [gif|mp4|webm]
+        visualize_play(int(argv[2]), int(argv[3]), play_title(int(argv[2]), int(argv[3])), int(argv[4]), argv[5],
+                       **({"writer": argv[6]} if len(argv) > 6 else {}))
+    elif argv[1] == "-b":
+        # Render every job in a CSV file: -b jobs.csv [workers]
+        render_batch(read_jobs(argv[2]), *[int(arg) for arg in argv[3:4]])
+    elif argv[1] == "-t":
+        # Render the top N TAA plays: -t N [workers]
+        render_batch(top_taa_jobs(int(argv[2])), *[int(arg) for arg in argv[3:4]])
+    elif argv[1] == "-c":
+        # Chart every defender's tackle probability over the play: -c game_id play_id out
+        chart_probabilities(int(argv[2]), int(argv[3]), argv[4])
     elif argv[1] == "-v":
         visualize_speed(int(argv[2]), int(argv[3]))
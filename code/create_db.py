@@ -1,13 +1,15 @@
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import multiprocessing
+import io
+import numpy as np
 import pandas as pd
 from psycopg2.extensions import AsIs, register_adapter
+import re
 import time
-from calc_vectors import calculate_vector
-from code.chart_play import *
+from features import add_snapshot_features
 import os
-from dotenv import load_dotenv
-load_dotenv()
-connection_string = os.environ["connection_string"]
+from db import connect, stream_chunks
 
 
 def adapt_int64(int64):
@@ -18,146 +20,339 @@ def adapt_bool(boolean):
     return AsIs(boolean)
 
 
+NA_VALUES = ["NA", "N/A"]
+
+# The compact schema every tracking reader parses with. A week of tracking is ~1.2M rows, so float32 positions and
+# categorical labels keep a whole season in RAM. nflId and jerseyNumber are nullable as the football has neither
+TRACKING_DTYPES = {"gameId": "int32", "playId": "int16", "nflId": "Int32", "displayName": "category",
+                   "frameId": "int16", "time": "category", "jerseyNumber": "Int8", "club": "category",
+                   "playDirection": "category", "x": "float32", "y": "float32", "s": "float32", "a": "float32",
+                   "dis": "float32", "o": "float32", "dir": "float32", "event": "category"}
+
+
+def clean_csv(path, drop: list = None, dtype: dict = None, flags: list = None, chunksize: int = None,
+              nullable: bool = True, usecols: list = None):
+    """Read a Big Data Bowl CSV with its missing values, dtypes and Y/N flags cleaned column by column"""
+    def clean(df):
+        if drop:
+            df = df.drop(drop, axis=1)
+        for col in flags or []:
+            df[col] = df[col].map({"Y": True, "N": False})
+        # Nullable dtypes keep integer columns with missing values as integers instead of floats
+        return df.convert_dtypes(infer_objects=False) if nullable else df
+
+    reader = pd.read_csv(path, na_values=NA_VALUES, dtype=dtype, chunksize=chunksize, usecols=usecols)
+    if chunksize is None:
+        return clean(reader)
+    return (clean(chunk) for chunk in reader)
+
+
+def clean_tracking(df):
+    """Apply the tracking specific rewrites to a cleaned tracking frame"""
+    df["nflId"] = df["nflId"].fillna(1)  # The football has no nflId
+    df["club"] = df["club"].cat.rename_categories({"football": "FB"})
+    # Speed/acceleration vectors, using the same rotation as calculate_vector. The football is left NULL
+    rads = np.radians((450 - df["dir"].astype("float64")) % 360).where(df["nflId"] != 1)
+    cos, sin = np.cos(rads).astype("float32"), np.sin(rads).astype("float32")
+    df["speed_x"], df["speed_y"] = df["s"] * cos, df["s"] * sin
+    df["acc_x"], df["acc_y"] = df["a"] * cos, df["a"] * sin
+    return df
+
+
+def read_tracking(path, drop: list = None, chunksize: int = None):
+    """Read a tracking CSV with the compact TRACKING_DTYPES schema and the tracking rewrites applied"""
+    reader = clean_csv(path, drop=drop, dtype=TRACKING_DTYPES, chunksize=chunksize, nullable=False)
+    if chunksize is None:
+        return clean_tracking(reader)
+    return (clean_tracking(df) for df in reader)
+
+
+def tracking_week(path):
+    """Get the week number from a tracking_week_N.csv path"""
+    return int(re.search(r"tracking_week_(\d+)\.csv$", path).group(1))
+
+
+def tracking_memory_report(directory):
+    """Print how much memory each week of tracking takes once parsed with the compact schema"""
+    total = 0
+    for path in sorted(glob.glob(os.path.join(directory, "tracking_week_*.csv")), key=tracking_week):
+        df = read_tracking(path)
+        size = df.memory_usage(deep=True).sum()
+        total += size
+        print(f"{os.path.basename(path)}: {len(df)} rows, {size / 2 ** 20:.1f} MiB ({size / len(df):.0f} bytes/row)")
+    print(f"Season: {total / 2 ** 20:.1f} MiB")
+    return total
+
+
+def get_tracking_columns(cur):
+    """Get the tracking columns that line up with a frame from tracking_copy_frame"""
+    # The CSV columns (minus displayName and jerseyNumber) line up with the first 15 columns of tracking
+    return get_table_columns(cur, "tracking", 15) + ["speed_x", "speed_y", "acc_x", "acc_y", "jerseynumber"]
+
+
+def tracking_copy_frame(df):
+    """Move jerseyNumber after the speed/acceleration vectors so a frame from read_tracking lines up with tracking"""
+    return df[[col for col in df.columns if col != "jerseyNumber"] + ["jerseyNumber"]]
+
+
+def get_table_columns(cur, table: str, limit: int = None):
+    """Get the column names of a table in the order they were declared"""
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s "
+                "ORDER BY ordinal_position LIMIT %s", (table, limit))
+    return [row[0] for row in cur.fetchall()]
+
+
+def copy_dataframe(cur, df, table: str, columns: list = None):
+    """COPY a cleaned frame into a table, matching its columns to the table's columns by position"""
+    if columns is None:
+        columns = get_table_columns(cur, table, len(df.columns))
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)  # Missing values are written as empty fields, i.e. NULL
+    buffer.seek(0)
+    cur.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(table, ", ".join(columns)), buffer)
+    return len(df)
+
+
+def read_games(path):
+    """Read and clean the games CSV"""
+    df = clean_csv(path, drop=["season"])  # games has no season column
+    df["gameDate"] = pd.to_datetime(df["gameDate"], format="%m/%d/%Y")
+    return df
+
+
+def read_players(path):
+    """Read and clean the players CSV"""
+    df = clean_csv(path)
+    return df[["nflId", "height", "weight", "collegeName", "position", "displayName"]]
+
+
+def read_plays(path):
+    """Read and clean the plays CSV"""
+    df = clean_csv(path, drop=["ballCarrierDisplayName", "yardlineSide", "yardlineNumber", "foulNFLId1", "foulNFLId2"],
+                   dtype={"foulName1": "object", "foulName2": "object"}, flags=["playNullifiedByPenalty"])
+    col = df.pop("absoluteYardlineNumber")
+    df.insert(9, col.name, col)
+    return df
+
+
+def read_tackles(path):
+    """Read and clean the tackles CSV"""
+    df = clean_csv(path)
+    for col in ["tackle", "assist", "forcedFumble", "pff_missedTackle"]:
+        df[col] = df[col].astype(bool)
+    return df
+
+
 def upload_games(path):
     """Upload games to psql db"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    for i in range(len(df)):
-        cur.execute("""INSERT INTO games VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (df["gameId"][i], df["week"][i], datetime.strptime(df["gameDate"][i], "%m/%d/%Y"),
-                     df["gameTimeEastern"][i], df["homeTeamAbbr"][i], df["visitorTeamAbbr"][i], df["homeFinalScore"][i],
-                     df["visitorFinalScore"][i]))
-    conn.commit()
+    with connect() as conn:
+        copy_dataframe(conn.cursor(), read_games(path), "games")
 
 
 def upload_players(path):
     """Upload players to psql db"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    for i in range(len(df)):
-        cur.execute("""INSERT INTO players VALUES (%s, %s, %s, %s, %s, %s)""",
-                    (df["nflId"][i], df["height"][i], df["weight"][i], df["collegeName"][i], df["position"][i],
-                     df["displayName"][i]))
-    conn.commit()
+    with connect() as conn:
+        copy_dataframe(conn.cursor(), read_players(path), "players")
 
 
 def upload_plays(path):
     """Upload plays to psql db"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    df = df.drop(["ballCarrierDisplayName", "yardlineSide", "yardlineNumber", "foulNFLId1", "foulNFLId2"], axis=1)
-    col = df.pop("absoluteYardlineNumber")
-    df.insert(9, col.name, col)
-    for col in ["passLength", "penaltyYards", "foulName1", "foulName2"]:
-        for i in range(len(df[col])):
-            if df.loc[i, col] == "N/A":
-                df.loc[i, col] = None
-    for i in range(len(df["playNullifiedByPenalty"])):
-        df.loc[i, "playNullifiedByPenalty"] = df.loc[i, "playNullifiedByPenalty"] == "Y"
-    df = df.astype(object).replace(np.nan, None)
-    for i in range(len(df)):
-        cur.execute("INSERT INTO plays VALUES (" + "%s, " * 29 + "%s)", [df[col][i] for col in df.columns])
-    conn.commit()
+    with connect() as conn:
+        copy_dataframe(conn.cursor(), read_plays(path), "plays")
 
 
 def upload_tackles(path):
-    """Upload tackle data to psql db"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    for i in range(len(df)):
-        cur.execute("INSERT INTO tackles VALUES (%s, %s, %s, CAST(%s as BOOL), CAST(%s as BOOL), CAST(%s as BOOL),"
-                    " CAST(%s as BOOL))", [df[col][i] for col in df.columns])
-    conn.commit()
+    """Upload tackle data to psql db, replacing the games in the file so a corrected file can be reloaded"""
+    df = read_tackles(path)
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM tackles WHERE game_id = ANY(%s)", (df["gameId"].unique().tolist(),))
+        copy_dataframe(cur, df, "tackles")
 
 
 def upload_tracking(path):
     """Upload tracking data to psql db"""
-    conn = psycopg2.connect("dbname=BigDataBowl user=cschneider")
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    df = df.drop(["displayName", "jerseyNumber"], axis=1)
-    for col in ["o", "dir"]:
-        for i in range(len(df[col])):
-            if df.loc[i, col] == "NA":
-                df.loc[i, col] = None
-    col = df["nflId"].astype(object).replace(np.nan, 1)
-    df["nflId"] = col
-    df = df.astype(object).replace(np.nan, None)
-    for i in range(len(df)):
-        data = [df[col][i] for col in df.columns]
-        if data[5] == "football":
-            data[5] = "FB"
-        cur.execute("INSERT INTO tracking VALUES (" + "%s, " * 14 + "%s)", data)
-    conn.commit()
-
-def add_jerseyNumber_to_tracking_for_specific_play(path, game_id, play_id):
-    """add_jerseyNumber to psql db for a specific play"""
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
-    df = pd.read_csv(path)
-    df["nflId"] = df["nflId"].astype(object).replace(np.nan, 1)
-    for col in ['gameId', 'playId', 'nflId']:
-        if df[col].dtype != 'int':
-            df[col] = df[col].astype(int)
-            
-    specific_play_df = df[(df['gameId'] == game_id) & (df['playId'] == play_id)]
-    
-    jersey_numbers = specific_play_df[['gameId', 'playId', 'nflId', 'jerseyNumber']]
-    
-    for _, row in jersey_numbers.iterrows():
-
-        game_id, play_id, nfl_id, jersey_number = row
-        cur.execute("UPDATE tracking SET jerseynumber = %s WHERE game_id = %s AND play_id = %s AND player_id = %s",
-                    (jersey_number, game_id, play_id, nfl_id))
-        
-        
-    conn.commit()
-    conn.close()
-    
-    
+    with connect() as conn:
+        cur = conn.cursor()
+        df = tracking_copy_frame(read_tracking(path, drop=["displayName"]))
+        copy_dataframe(cur, df, "tracking", get_tracking_columns(cur))
+    create_indexes()
+
+
+def copy_tracking_csv(cur, path, table: str = "tracking", chunk_size: int = 500000):
+    """COPY a tracking CSV into a table chunk by chunk"""
+    columns = get_tracking_columns(cur)
+    rows = 0
+    for df in read_tracking(path, drop=["displayName"], chunksize=chunk_size):
+        rows += copy_dataframe(cur, tracking_copy_frame(df), table, columns)
+    return rows
+
+
+def upload_tracking_bulk(path, chunk_size: int = 500000):
+    """Stream tracking data into psql db in chunks with COPY FROM STDIN"""
+    start_time = time.time()
+    with connect() as conn:
+        rows = copy_tracking_csv(conn.cursor(), path, chunk_size=chunk_size)
+    duration = time.time() - start_time
+    print(f"Uploaded {rows} tracking rows in {duration:.2f} seconds ({rows / max(duration, 1e-9):.0f} rows/sec)")
+    create_indexes()
+    return rows
+
+
+def stage_tracking_week(path, chunk_size: int = 500000):
+    """Load one tracking week into its own staging table, replacing any earlier attempt at that week"""
+    week = tracking_week(path)
+    stage = "tracking_stage_week_{0}".format(week)
+    # Each worker process has its own pool, so the weeks it loads reuse its connection
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("DROP TABLE IF EXISTS {0}".format(stage))
+        cur.execute("CREATE UNLOGGED TABLE {0} (LIKE tracking INCLUDING DEFAULTS)".format(stage))
+        rows = copy_tracking_csv(cur, path, stage, chunk_size)
+    return week, stage, rows
+
+
+def merge_tracking_stage(cur, stage: str):
+    """Replace the games held in a staging table with its rows, so re-running a week never duplicates rows"""
+    cur.execute("DELETE FROM tracking WHERE game_id IN (SELECT DISTINCT game_id FROM {0})".format(stage))
+    cur.execute("INSERT INTO tracking SELECT * FROM {0}".format(stage))
+    cur.execute("DROP TABLE {0}".format(stage))
+
+
+# Indexes for the hot lookups, created once the bulk load is done so COPY doesn't have to maintain them
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS tracking_play_frame_idx ON tracking (game_id, play_id, frame_id)",
+    "CREATE INDEX IF NOT EXISTS tracking_play_player_event_idx ON tracking (game_id, play_id, player_id, event)",
+    "CREATE INDEX IF NOT EXISTS tracking_pass_arrived_idx ON tracking (game_id, play_id, player_id) "
+    "WHERE event='pass_arrived'",
+    "CREATE INDEX IF NOT EXISTS tackles_play_player_idx ON tackles (game_id, play_id, player_id)",
+]
+
+
+def create_indexes():
+    """Create the indexes used by the model and chart queries and refresh the planner statistics"""
+    with connect() as conn:
+        cur = conn.cursor()
+        for index in INDEXES:
+            cur.execute(index)
+        cur.execute("ANALYZE tracking")
+        cur.execute("ANALYZE tackles")
+
+
+def load_all_weeks(directory, workers: int = 4, weeks: list = None, chunk_size: int = 500000):
+    """Load every tracking_week_N.csv in a directory in parallel, then merge the staged weeks into tracking"""
+    paths = sorted(glob.glob(os.path.join(directory, "tracking_week_*.csv")), key=tracking_week)
+    if weeks is not None:
+        paths = [path for path in paths if tracking_week(path) in weeks]
+    start_time = time.time()
+    staged, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(stage_tracking_week, path, chunk_size): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                week, stage, rows = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Failed to load {futures[future]}: {e}")
+                continue
+            staged.append(stage)
+            print(f"Staged week {week}: {rows} rows")
+    # Merge every staged week in one transaction
+    with connect() as conn:
+        cur = conn.cursor()
+        for stage in sorted(staged):
+            merge_tracking_stage(cur, stage)
+    create_indexes()
+    print(f"Loaded {len(staged)} weeks in {time.time() - start_time:.2f} seconds")
+    return failed
+
+
+def backfill_jersey_numbers(paths: list):
+    """Backfill jerseynumber on tracking loaded before it was kept, from one (game_id, nflId) mapping and one UPDATE"""
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE jersey_numbers (game_id INT, player_id INT, jersey_number INT) ON COMMIT DROP")
+        for path in paths:
+            # A player wears one number per game, so only the distinct (game, player) pairs are needed
+            df = clean_csv(path, dtype=TRACKING_DTYPES, usecols=["gameId", "nflId", "jerseyNumber"], nullable=False)
+            copy_dataframe(cur, df.dropna().drop_duplicates(["gameId", "nflId"]), "jersey_numbers",
+                           ["game_id", "player_id", "jersey_number"])
+        cur.execute("ANALYZE jersey_numbers")
+        cur.execute("UPDATE tracking t SET jerseynumber=j.jersey_number FROM jersey_numbers j "
+                    "WHERE t.game_id=j.game_id AND t.player_id=j.player_id "
+                    "AND t.jerseynumber IS DISTINCT FROM j.jersey_number")
+        return cur.rowcount
+
+
+# Rows loaded through clean_tracking already have their vectors, so this only backfills legacy rows.
+# Same maths as calculate_vector: the direction is rotated with (450 - dir) % 360 and
+# the modulo is dropped since cos and sin are already periodic in 360 degrees
+SA_VECTORS_UPDATE = ("UPDATE tracking SET "
+                     "speed_x=speed * cos(radians(450 - direction)), speed_y=speed * sin(radians(450 - direction)), "
+                     "acc_x=acceleration * cos(radians(450 - direction)), "
+                     "acc_y=acceleration * sin(radians(450 - direction)) "
+                     "WHERE player_id!=1 AND speed_x IS NULL")
+
 
 def compute_sa_vectors():
-    """Compute speed/acceleration vectors for tracking data"""
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
-    cur.execute("SELECT game_id, play_id, player_id, frame_id, speed, acceleration, direction FROM tracking "
-                "WHERE player_id!=1")
-    data = cur.fetchall()
-
-    for frame in data:
-        speed_x, speed_y = calculate_vector(frame[4], frame[6])
-        acc_x, acc_y = calculate_vector(frame[5], frame[6])
-        cur.execute("UPDATE tracking SET speed_x=%s, speed_y=%s, acc_x=%s, acc_y=%s "
-                    "WHERE game_id=%s AND play_id=%s AND player_id=%s AND frame_id=%s",
-                    [speed_x, speed_y, acc_x, acc_y] + list(frame[:4]))
-    conn.commit()
-    conn.close()
+    """Backfill speed/acceleration vectors for tracking data loaded without them"""
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute(SA_VECTORS_UPDATE)
+
 
 def compute_sa_vectors_for_a_specific_play(game_id: int, play_id: int):
-    """Compute speed/acceleration vectors for a specific play for tracking data"""
-    conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
-    cur.execute("SELECT game_id, play_id, player_id, frame_id, speed, acceleration, direction FROM tracking "
-                "WHERE player_id!=1 AND game_id=%s AND play_id=%s", [game_id, play_id])
-    data = cur.fetchall()
-    for frame in data:
-        speed_x, speed_y = calculate_vector(frame[4], frame[6])
-        acc_x, acc_y = calculate_vector(frame[5], frame[6])
-        cur.execute("UPDATE tracking SET speed_x=%s, speed_y=%s, acc_x=%s, acc_y=%s "
-                    "WHERE game_id=%s AND play_id=%s AND player_id=%s AND frame_id=%s",
-                    [speed_x, speed_y, acc_x, acc_y] + list(frame[:4]))
-    conn.commit()
-    conn.close()
-    
+    """Backfill speed/acceleration vectors for a specific play for tracking data loaded without them"""
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute(SA_VECTORS_UPDATE + " AND game_id=%s AND play_id=%s", [game_id, play_id])
+
+
+CATCH_SNAPSHOTS_TABLE = ("CREATE TABLE IF NOT EXISTS catch_snapshots (game_id INT, play_id INT, week INT, "
+                         "player_id INT, team TEXT, defender BOOL, tackler BOOL, frame_id INT, orientation FLOAT, "
+                         "x FLOAT, y FLOAT, speed FLOAT, acceleration FLOAT, bc_x FLOAT, bc_y FLOAT, "
+                         "sqrt_lateral FLOAT, sqrt_distance FLOAT, PRIMARY KEY (game_id, play_id, player_id))")
+
+
+def build_catch_snapshots(week: int = None, game_ids: list = None):
+    """Rebuild the snapshot of every player at the moment of the catch for one week, some games, or the whole season"""
+    filters = ([] if week is None else ["{0}week=%(week)s"]) + ([] if game_ids is None else
+                                                                 ["{0}game_id = ANY(%(game_ids)s)"])
+    where = " AND ".join(filters) or "TRUE"
+    params = {"week": week, "game_ids": None if game_ids is None else list(game_ids)}
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute(CATCH_SNAPSHOTS_TABLE)
+        cur.execute("DELETE FROM catch_snapshots WHERE " + where.format(""), params)
+        rows = 0
+        for chunk in stream_chunks(conn, "WITH ball_carriers AS ("
+                                   "    SELECT t.game_id, t.play_id, t.x, t.y, t.team FROM plays p JOIN tracking t "
+                                   "    ON t.game_id=p.game_id AND t.play_id=p.play_id AND t.player_id=p.ball_carrier "
+                                   "    WHERE t.event='pass_arrived'"
+                                   "), tacklers AS ("
+                                   "    SELECT DISTINCT game_id, play_id, player_id FROM tackles "
+                                   "    WHERE tackle='t' OR assist='t'"
+                                   ") "
+                                   "SELECT t.game_id, t.play_id, g.week, t.player_id, t.team, "
+                                   "t.team!=bc.team AND t.team!='FB', tk.player_id IS NOT NULL, t.frame_id, "
+                                   "t.orientation, t.x, t.y, t.speed, t.acceleration, bc.x, bc.y "
+                                   "FROM ball_carriers bc JOIN games g ON g.game_id=bc.game_id JOIN tracking t "
+                                   "ON t.game_id=bc.game_id AND t.play_id=bc.play_id AND t.event='pass_arrived' "
+                                   "LEFT JOIN tacklers tk "
+                                   "ON tk.game_id=t.game_id AND tk.play_id=t.play_id AND tk.player_id=t.player_id "
+                                   "WHERE " + where.format("g."), params):
+            df = pd.DataFrame(chunk, columns=["game_id", "play_id", "week", "player_id", "team", "defender", "tackler",
+                                              "frame_id", "orientation", "x", "y", "speed", "acceleration",
+                                              "bc_x", "bc_y"])
+            add_snapshot_features(df)
+            rows += copy_dataframe(cur, df, "catch_snapshots", list(df.columns))
+        return rows
+
 
 if __name__ == "__main__":
     
     start_time = time.time()
-    add_jerseyNumber_to_tracking_for_specific_play("/Users/winch/Data Science & Machine Learning Projects/BigDataBowl2024/data/nfl-big-data-bowl-2024/tracking_week_2.csv", 2022091807, 1294)
+    backfill_jersey_numbers(glob.glob("/Users/winch/Data Science & Machine Learning Projects/BigDataBowl2024/data/nfl-big-data-bowl-2024/tracking_week_*.csv"))
     end_time = time.time()
     duration = end_time - start_time
 
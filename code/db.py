@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+import itertools
+from psycopg2.pool import ThreadedConnectionPool
+import os
+from dotenv import load_dotenv
+load_dotenv()
+connection_string = os.environ.get("connection_string")  # Unset when only the parquet storage backend is used
+pool_size = int(os.environ.get("pool_size", 4))
+itersize = int(os.environ.get("itersize", 50000))
+
+pool = None
+pool_pid = None
+inherited_pools = []
+cursor_ids = itertools.count()
+
+
+def get_pool():
+    """Get this process's connection pool, creating it on first use"""
+    global pool, pool_pid
+    # A forked worker must not share the parent's sockets, so every process gets its own pool. The worker pools in
+    # create_db and chart_play are spawned as well, so their workers open their own connections from the start
+    if pool is None or pool_pid != os.getpid():
+        if pool is not None:
+            # Freeing the parent's pool here would close its connections, terminating the parent's sessions too
+            inherited_pools.append(pool)
+        pool = ThreadedConnectionPool(1, pool_size, connection_string)
+        pool_pid = os.getpid()
+    return pool
+
+
+@contextmanager
+def connect():
+    """Borrow a pooled connection, committing when the block succeeds and rolling back when it raises"""
+    conn = get_pool().getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        get_pool().putconn(conn)
+
+
+def stream(conn, query: str, params=None, size: int = None):
+    """Run a large read through a server-side cursor that fetches size rows per round trip"""
+    cur = conn.cursor(name="stream_{0}".format(next(cursor_ids)))
+    cur.itersize = size or itersize
+    cur.execute(query, params)
+    return cur
+
+
+def stream_chunks(conn, query: str, params=None, size: int = None):
+    """Yield the rows of a large read in lists of at most size rows, so peak memory doesn't grow with the table"""
+    cur = stream(conn, query, params, size)
+    while True:
+        rows = cur.fetchmany(cur.itersize)
+        if not rows:
+            break
+        yield rows
+    cur.close()
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def tackle_features(ball_carrier, defenders):
+    """Calculate the tackle probability model features for many defenders at once
+
+    ball_carrier holds the x, y of the ball carrier, either once for every defender or one row per defender.
+    defenders holds one x, y, speed, acceleration row per defender.
+    Returns one sqrt lateral distance, sqrt Euclidean distance, speed, acceleration row per defender.
+    """
+    defenders = np.asarray(defenders, dtype=np.float64).reshape(-1, 4)
+    ball_carrier = np.broadcast_to(np.asarray(ball_carrier, dtype=np.float64), (len(defenders), 2))
+    dx = ball_carrier[:, 0] - defenders[:, 0]
+    dy = ball_carrier[:, 1] - defenders[:, 1]
+    return np.column_stack((np.sqrt(np.abs(dy)),  # Sqrt of lateral distance
+                            np.sqrt(np.sqrt(dx ** 2 + dy ** 2)),  # Sqrt of Euclidean distance
+                            defenders[:, 2], defenders[:, 3]))  # Speed and acceleration
+
+
+def add_snapshot_features(df):
+    """Set the sqrt_lateral and sqrt_distance columns of a catch snapshot frame from its ball carrier and defender"""
+    features = tackle_features(df[["bc_x", "bc_y"]].to_numpy(dtype=np.float64),
+                               df[["x", "y", "speed", "acceleration"]].to_numpy(dtype=np.float64))
+    df["sqrt_lateral"], df["sqrt_distance"] = features[:, 0], features[:, 1]
+    return df
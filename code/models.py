@@ -0,0 +1,28 @@
+import hashlib
+import io
+from joblib import load
+import os
+
+# path -> (mtime, size, model, version) of every model this process has loaded
+models = {}
+
+
+def model_version(data: bytes):
+    """Name a model artifact by the first 12 hex digits of its SHA-256, so different contents never share a version"""
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def load_model(path: str = "model.joblib"):
+    """Get a model and its version, unpickling it only the first time this process sees that version of the file"""
+    stat = os.stat(path)
+    cached = models.get(path)
+    # An unchanged mtime and size means the cached model is still current without re-reading the file
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2], cached[3]
+    with open(path, "rb") as f:
+        data = f.read()
+    version = model_version(data)
+    # Touched but identical files keep the cached model; anything else is unpickled from the bytes just hashed
+    model = cached[2] if cached is not None and cached[3] == version else load(io.BytesIO(data))
+    models[path] = (stat.st_mtime_ns, stat.st_size, model, version)
+    return model, version
@@ -0,0 +1,184 @@
+from functools import lru_cache
+import glob
+import json
+import numpy as np
+import pandas as pd
+import re
+import shutil
+from sys import argv
+import os
+from create_db import read_games, read_players, read_plays, read_tackles, read_tracking, tracking_week
+from features import add_snapshot_features
+from db import connect, stream_chunks
+# "postgres" reads through connection_string, "parquet" reads the files convert_csvs writes to parquet_dir
+backend = os.environ.get("storage", "postgres")
+parquet_dir = os.environ.get("parquet_dir", "parquet")
+
+# Every defender at the moment of the catch with their model features and whether they made the tackle
+CATCH_DEFENDERS_COLUMNS = ["game_id", "play_id", "player_id", "team", "sqrt_lateral", "sqrt_distance", "speed",
+                           "acceleration", "tackler"]
+CATCH_DEFENDERS_QUERY = "SELECT " + ", ".join(CATCH_DEFENDERS_COLUMNS) + " FROM catch_snapshots WHERE defender"
+
+# CSV columns whose table column isn't just the snake case of the CSV name
+COLUMN_NAMES = {"nflId": "player_id", "club": "team", "s": "speed", "a": "acceleration", "o": "orientation",
+                "dir": "direction", "playDirection": "lr", "jerseyNumber": "jerseynumber",
+                "ballCarrierId": "ball_carrier", "playDescription": "play"}
+PLAYER_COLUMN_NAMES = {"nflId": "id", "displayName": "name"}
+
+
+def table_columns(df, names: dict = None):
+    """Rename a cleaned CSV frame's columns to the names used by the database tables"""
+    names = {**COLUMN_NAMES, **(names or {})}
+    return df.rename(columns=lambda col: names.get(col, re.sub(r"(?<!^)(?=[A-Z])", "_", col).lower()))
+
+
+def convert_csvs(directory: str, output: str = None, chunk_size: int = 500000):
+    """Convert the Big Data Bowl CSVs into Parquet once, partitioning tracking by week and game"""
+    output = output or parquet_dir
+    os.makedirs(output, exist_ok=True)
+    table_columns(read_games(os.path.join(directory, "games.csv"))).to_parquet(
+        os.path.join(output, "games.parquet"), index=False)
+    table_columns(read_players(os.path.join(directory, "players.csv")), PLAYER_COLUMN_NAMES).to_parquet(
+        os.path.join(output, "players.parquet"), index=False)
+    table_columns(read_plays(os.path.join(directory, "plays.csv"))).to_parquet(
+        os.path.join(output, "plays.parquet"), index=False)
+    table_columns(read_tackles(os.path.join(directory, "tackles.csv"))).to_parquet(
+        os.path.join(output, "tackles.parquet"), index=False)
+    for path in sorted(glob.glob(os.path.join(directory, "tracking_week_*.csv")), key=tracking_week):
+        week = tracking_week(path)
+        # Replace the week's partition so converting a week again doesn't duplicate its rows
+        shutil.rmtree(os.path.join(output, "tracking", "week={0}".format(week)), ignore_errors=True)
+        for df in read_tracking(path, drop=["displayName"], chunksize=chunk_size):
+            df = table_columns(df)
+            # read_tracking parses gameId as int32; widen the partition keys to the int64 read_table reads them back as
+            df["week"], df["game_id"] = week, df["game_id"].astype(np.int64)
+            df.to_parquet(os.path.join(output, "tracking"), partition_cols=["week", "game_id"], index=False)
+        print("Converted {0}".format(path))
+
+
+def read_table(table: str, columns: list = None, filters: list = None):
+    """Scan a converted table, reading only the columns asked for and the partitions and rows matching filters"""
+    path = os.path.join(parquet_dir, table if table == "tracking" else table + ".parquet")
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    for col in {"week", "game_id"} & set(df.columns):
+        df[col] = df[col].astype(np.int64)  # Partition keys are read back as categories
+    return df
+
+
+def build_catch_snapshots(week: int = None):
+    """Rebuild catch_snapshots.parquet, the Parquet counterpart of create_db.build_catch_snapshots"""
+    filters = [("event", "==", "pass_arrived")] + ([("week", "==", week)] if week is not None else [])
+    tracking = read_table("tracking", ["game_id", "play_id", "week", "player_id", "team", "frame_id", "orientation",
+                                       "x", "y", "speed", "acceleration"], filters)
+    plays = read_table("plays", ["game_id", "play_id", "ball_carrier"])
+    ball_carriers = tracking.merge(plays, left_on=["game_id", "play_id", "player_id"],
+                                   right_on=["game_id", "play_id", "ball_carrier"])
+    ball_carriers = ball_carriers[["game_id", "play_id", "x", "y", "team"]].rename(
+        columns={"x": "bc_x", "y": "bc_y", "team": "bc_team"})
+    tackles = read_table("tackles", ["game_id", "play_id", "player_id", "tackle", "assist"])
+    tacklers = tackles[tackles["tackle"] | tackles["assist"]][["game_id", "play_id", "player_id"]].drop_duplicates()
+    df = tracking.merge(ball_carriers, on=["game_id", "play_id"]).merge(tacklers.assign(tackler=True), how="left",
+                                                                        on=["game_id", "play_id", "player_id"])
+    df["tackler"] = df["tackler"].fillna(False).astype(bool)
+    df["defender"] = ((df["team"] != df.pop("bc_team")) & (df["team"] != "FB")).astype(bool)
+    add_snapshot_features(df)
+    path = os.path.join(parquet_dir, "catch_snapshots.parquet")
+    if week is not None and os.path.exists(path):
+        snapshots = pd.read_parquet(path)
+        df = pd.concat([snapshots[snapshots["week"] != week], df], ignore_index=True)
+    df.to_parquet(path, index=False)
+    return len(df)
+
+
+def catch_defender_chunks(game_ids: list = None):
+    """Yield lists of CATCH_DEFENDERS_COLUMNS rows for every defender at the catch from the configured backend"""
+    if backend == "parquet":
+        filters = [("defender", "==", True)] + ([("game_id", "in", list(game_ids))] if game_ids is not None else [])
+        df = read_table("catch_snapshots", CATCH_DEFENDERS_COLUMNS, filters)
+        yield list(df.itertuples(index=False, name=None))
+        return
+    query, params = CATCH_DEFENDERS_QUERY, []
+    if game_ids is not None:
+        query += " AND game_id = ANY(%s)"
+        params.append(list(game_ids))
+    with connect() as conn:
+        yield from stream_chunks(conn, query, params)
+
+
+def lookup(table: str, column: str, **keys):
+    """Get a column of the row of a table matching keys, from the configured backend"""
+    if backend == "parquet":
+        return read_table(table, [column], [(key, "==", value) for key, value in keys.items()])[column].iloc[0]
+    with connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT {0} FROM {1} WHERE ".format(column, table) +
+                    " AND ".join("{0}=%s".format(key) for key in keys), tuple(keys.values()))
+        return cur.fetchone()[0]
+
+
+# The per-player tracking fields a loaded play holds, in column order
+PLAY_FIELDS = ["x", "y", "orientation", "speed", "acceleration", "speed_x", "speed_y", "acc_x", "acc_y"]
+# The categorical tracking columns, stored in the play index as int8 codes into labels.json (-1 for missing)
+INDEX_LABELS = ["team", "event"]
+
+
+def build_play_index(output: str = None):
+    """Write the season's tracking, sorted by play, frame and player, to .npy files that open_play_index memory maps
+
+    plays.npy holds one game_id, play_id, start, stop row per play, so a play is rows start:stop of every array.
+    """
+    output = output or os.path.join(parquet_dir, "play_index")
+    os.makedirs(output, exist_ok=True)
+    df = read_table("tracking", ["game_id", "play_id", "frame_id", "player_id", "jerseynumber"] + INDEX_LABELS +
+                    PLAY_FIELDS)
+    df = df.sort_values(["game_id", "play_id", "frame_id", "player_id"], ignore_index=True)
+    np.save(os.path.join(output, "frame_id.npy"), df["frame_id"].to_numpy(dtype=np.int16))
+    np.save(os.path.join(output, "player_id.npy"), df["player_id"].to_numpy(dtype=np.int32))
+    np.save(os.path.join(output, "jersey_number.npy"), df["jerseynumber"].to_numpy(dtype=np.float32, na_value=np.nan))
+    np.save(os.path.join(output, "data.npy"), df[PLAY_FIELDS].to_numpy(dtype=np.float32, na_value=np.nan))
+    labels = {}
+    for col in INDEX_LABELS:
+        values = df[col].astype("category")
+        labels[col] = list(values.cat.categories)
+        np.save(os.path.join(output, col + ".npy"), values.cat.codes.to_numpy(dtype=np.int8))
+    with open(os.path.join(output, "labels.json"), "w") as f:
+        json.dump(labels, f)
+    keys = df[["game_id", "play_id"]].to_numpy(dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    np.save(os.path.join(output, "plays.npy"), np.column_stack((keys[starts], starts, np.r_[starts[1:], len(df)])))
+    return len(starts)
+
+
+@lru_cache(maxsize=None)
+def open_play_index(path: str = None):
+    """Memory map the play index once per process. Processes opening the same files share their pages"""
+    path = path or os.path.join(parquet_dir, "play_index")
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+              for name in ["frame_id", "player_id", "jersey_number", "data"] + INDEX_LABELS}
+    with open(os.path.join(path, "labels.json")) as f:
+        labels = {col: np.array(values + [None], dtype=object) for col, values in json.load(f).items()}
+    offsets = {(game_id, play_id): slice(start, stop)
+               for game_id, play_id, start, stop in np.load(os.path.join(path, "plays.npy")).tolist()}
+    return arrays, labels, offsets
+
+
+def play_index_rows(game_id: int, play_id: int, path: str = None):
+    """Get a play's rows from the play index as zero-copy slices of the memory-mapped arrays"""
+    arrays, labels, offsets = open_play_index(path)
+    rows = offsets[(game_id, play_id)]
+    play = {name: array[rows] for name, array in arrays.items()}
+    for col in INDEX_LABELS:
+        play[col] = labels[col][play[col]]  # Code -1 picks the trailing None
+    return play
+
+
+if __name__ == "__main__":
+    if argv[1] == "-c":
+        # Convert the CSVs in a directory to Parquet: -c directory
+        convert_csvs(argv[2])
+    elif argv[1] == "-s":
+        # Rebuild the catch snapshots for one week or the whole season: -s [week]
+        build_catch_snapshots(*[int(arg) for arg in argv[2:3]])
+    elif argv[1] == "-i":
+        # Build the memory-mapped play index: -i [output]
+        build_play_index(*argv[2:3])